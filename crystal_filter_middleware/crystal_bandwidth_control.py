@@ -0,0 +1,227 @@
+from swift.common.swob import Request
+from crystal_filter_control import Singleton
+import eventlet
+import socket
+import redis
+import time
+import os
+
+MB = 1024 * 1024
+# Sync intervals without requests after which a limit is forgotten
+EVICTION_INTERVALS = 3
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at 'rate' tokens per second up to 'burst' tokens.
+    Consumers are allowed to get into debt, and they pay it by sleeping the
+    time needed to refill it, so no one busy-waits for tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def set_rate(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def consume(self, amount):
+        """
+        Take tokens from the bucket
+        :param amount: number of tokens to take
+        :returns: seconds to wait before going on
+        """
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class BandwidthLimit(object):
+    """
+    Token buckets (bandwidth and operations) shared by all the requests of a
+    policy target in this process
+    """
+
+    def __init__(self):
+        self.bandwidth = None
+        self.ops = None
+        self.synced = 0
+
+    def _update_bucket(self, bucket, rate, burst):
+        if not rate:
+            return None
+        if bucket:
+            bucket.set_rate(rate, burst)
+            return bucket
+        return TokenBucket(rate, burst)
+
+    def update(self, bw_rate, ops_rate, burst_time):
+        self.bandwidth = self._update_bucket(self.bandwidth, bw_rate,
+                                             bw_rate * burst_time)
+        self.ops = self._update_bucket(self.ops, ops_rate,
+                                       max(1, ops_rate * burst_time))
+        self.synced = time.time()
+
+
+class BandwidthThrottledIter(object):
+    """
+    Wraps a data source (GET app_iter or PUT wsgi.input) and throttles it at
+    chunk granularity
+    """
+
+    def __init__(self, source, bucket):
+        self.source = source
+        self.bucket = bucket
+        self._iter = None
+
+    def _throttle(self, chunk):
+        wait = self.bucket.consume(len(chunk))
+        if wait:
+            eventlet.sleep(wait)
+        return chunk
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iter is None:
+            self._iter = iter(self.source)
+        return self._throttle(next(self._iter))
+
+    __next__ = next
+
+    def read(self, size=-1):
+        return self._throttle(self.source.read(size))
+
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+@Singleton
+class CrystalBandwidthControl(object):
+    """
+    Global native filter that shapes GET/PUT streams per account/container.
+
+    The policies are read from the 'bandwidth:<account>[/<container>]'
+    hashes, with the '<method>_bw' (MB/s) and '<method>_ops' (requests/s)
+    fields. The container policy has precedence over the account policy.
+    Each node announces itself as active for a policy target every sync
+    interval, and the rates are split among the active nodes, so the
+    policy is shared approximately across proxies.
+    """
+
+    def __init__(self, filter_conf, global_conf, logger):
+        self.logger = logger
+        self.conf = global_conf
+        self.sync_interval = float(global_conf.get('bandwidth_sync_interval',
+                                                   5))
+        self.burst_time = float(global_conf.get('bandwidth_burst_time', 1))
+        self.redis = redis.StrictRedis(global_conf.get('redis_host'),
+                                       global_conf.get('redis_port'),
+                                       global_conf.get('redis_db'))
+        self.node_id = socket.gethostname() + ':' + str(os.getpid())
+
+        # (account, container, method) -> BandwidthLimit
+        self.limits = dict()
+        # (target, method) -> BandwidthLimit
+        self.target_limits = dict()
+        self.last_eviction = time.time()
+
+    def _sync_limit(self, account, container, method):
+        pipe = self.redis.pipeline()
+        pipe.hgetall('bandwidth:' + account + '/' + container)
+        pipe.hgetall('bandwidth:' + account)
+        container_policy, account_policy = pipe.execute()
+
+        for target, policy in ((account + '/' + container, container_policy),
+                               (account, account_policy)):
+            bw_rate = float(policy.get(method + '_bw', 0)) * MB
+            ops_rate = float(policy.get(method + '_ops', 0))
+            if bw_rate or ops_rate:
+                break
+        else:
+            limit = BandwidthLimit()
+            limit.update(0, 0, self.burst_time)
+            return limit
+
+        now = time.time()
+        nodes_key = 'bandwidth_nodes:' + target + ':' + method
+        pipe = self.redis.pipeline()
+        pipe.hset(nodes_key, self.node_id, now)
+        pipe.expire(nodes_key, int(2 * self.sync_interval) + 1)
+        pipe.hgetall(nodes_key)
+        active_nodes = pipe.execute()[2]
+
+        # Nodes that did not sync in the last intervals are not active
+        stale_nodes = [node for node, synced in active_nodes.items()
+                       if float(synced) < now - 2 * self.sync_interval]
+        if stale_nodes:
+            self.redis.hdel(nodes_key, *stale_nodes)
+        nodes = max(1, len(active_nodes) - len(stale_nodes))
+
+        limit = self.target_limits.get((target, method))
+        if not limit:
+            limit = BandwidthLimit()
+            self.target_limits[(target, method)] = limit
+        limit.update(bw_rate / nodes, ops_rate / nodes, self.burst_time)
+
+        return limit
+
+    def _evict_limits(self, now):
+        """
+        Forget the limits that have not been synced in the last intervals,
+        so the workers do not keep a limit for every container ever seen
+        """
+        expired = now - EVICTION_INTERVALS * self.sync_interval
+        for limits in (self.limits, self.target_limits):
+            for key in [key for key, limit in limits.items()
+                        if limit.synced < expired]:
+                del limits[key]
+        self.last_eviction = now
+
+    def _get_limit(self, account, container, method):
+        now = time.time()
+        if now - self.last_eviction > self.sync_interval:
+            self._evict_limits(now)
+
+        key = (account, container, method)
+        limit = self.limits.get(key)
+        if not limit or now - limit.synced > self.sync_interval:
+            limit = self._sync_limit(account, container, method)
+            self.limits[key] = limit
+        return limit
+
+    def execute(self, req_resp, crystal_iter, request_data):
+        if crystal_iter is None:
+            if isinstance(req_resp, Request):
+                crystal_iter = req_resp.environ['wsgi.input']
+            else:
+                crystal_iter = req_resp.app_iter
+
+        limit = self._get_limit(request_data['account'],
+                                request_data['container'],
+                                request_data['method'])
+
+        if limit.ops:
+            wait = limit.ops.consume(1)
+            if wait:
+                eventlet.sleep(wait)
+
+        if limit.bandwidth:
+            self.logger.debug('Crystal Filters - Throttling ' +
+                              request_data['method'].upper() + ' of ' +
+                              request_data['account'] + '/' +
+                              request_data['container'])
+            return BandwidthThrottledIter(crystal_iter, limit.bandwidth)
+
+        return crystal_iter
@@ -0,0 +1,357 @@
+from swift.common.swob import Request
+from swift.common.utils import config_true_value
+from crystal_filter_control import Singleton
+import crystal_filter_common as sc
+import numpy as np
+import re
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+DELIMITERS = {'comma': ',', 'semicolon': ';', 'tab': '\t', 'pipe': '|',
+              'space': ' '}
+PREDICATE = re.compile(r'^\s*(.+?)\s*(>=|<=|==|!=|>|<)\s*(.*?)\s*$')
+# Longer fields are not parsed as numbers in a vectorized way
+NUMBER_WIDTH = 64
+# Bytes read at a time from a file-like source (PUT wsgi.input)
+READ_CHUNK_SIZE = 65536
+
+
+class CSVQuery(object):
+    """
+    Selection and projection of a filter stage, parsed from its parameters:
+
+        select=<col>|<col>   columns to return (all by default)
+        where=<col><op><value>|...   predicates that all rows must meet,
+                                     with the operators >, >=, ==, !=, <=, <
+        header=true|false    whether the first row has the column names
+        delimiter=<name or character>   comma (default), semicolon, tab...
+
+    Columns are referenced by name when there is a header, or by their
+    0-based index. Quoted fields with delimiters or newlines inside are not
+    supported.
+    """
+
+    def __init__(self, params):
+        options = dict()
+        for param in params.split(','):
+            if '=' in param:
+                key, value = param.split('=', 1)
+                options[key.strip()] = value.strip()
+
+        self.header = config_true_value(options.get('header', 'true'))
+        delimiter = options.get('delimiter', 'comma')
+        self.delimiter = DELIMITERS.get(delimiter, delimiter).encode('ascii')
+        if len(self.delimiter) != 1:
+            raise ValueError('Invalid delimiter: ' + delimiter)
+
+        self.select = [column.strip() for column in
+                       options.get('select', '').split('|') if column.strip()]
+        self.where = []
+        for predicate in options.get('where', '').split('|'):
+            if not predicate.strip():
+                continue
+            match = PREDICATE.match(predicate)
+            if not match:
+                raise ValueError('Invalid predicate: ' + predicate)
+            column, op, value = match.groups()
+            self.where.append((column, sc.mappings[op], value))
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _to_numbers(fields):
+    """
+    Vectorized conversion of a column to floats. Fields that are not
+    numbers (i.e. empty fields) are NaN
+    """
+    try:
+        return fields.astype(np.float64)
+    except ValueError:
+        return np.array([_to_number(field) for field in fields],
+                        dtype=np.float64)
+
+
+class CSVFilterIter(object):
+    """
+    Filters the rows of a CSV body chunk by chunk. The rows of each chunk
+    are located and evaluated with NumPy on the raw bytes, and the last
+    incomplete row is carried over to the next chunk. It can be iterated
+    (GET app_iter) or read (PUT wsgi.input).
+    """
+
+    def __init__(self, obj_data, query, logger):
+        self.obj_data = obj_data
+        self.query = query
+        self.logger = logger
+        self.delimiter = np.frombuffer(query.delimiter, dtype=np.uint8)[0]
+        self.columns = None
+        self.ncols = 0
+        self.projection = None
+        self.predicates = None
+        self.tail = b''
+        self.buffer = b''
+        self._iter = None
+
+    def __iter__(self):
+        return self
+
+    def _column_index(self, column):
+        if column in self.columns:
+            return self.columns[column]
+        try:
+            return int(column)
+        except ValueError:
+            raise ValueError('Unknown column: ' + column)
+
+    def _bind(self, header_row):
+        """
+        Resolve the columns of the query, and return the header row to send
+        """
+        names = header_row.rstrip(b'\r').split(self.query.delimiter)
+        self.ncols = len(names)
+        self.columns = dict()
+        if self.query.header:
+            self.columns = dict((name.decode('utf-8'), index)
+                                for index, name in enumerate(names))
+
+        if self.query.select:
+            self.projection = [self._column_index(column)
+                               for column in self.query.select]
+        self.predicates = []
+        for column, op, value in self.query.where:
+            number = _to_number(value)
+            self.predicates.append((self._column_index(column), op,
+                                    value.encode('utf-8'), number))
+
+        for index in (self.projection or []) + \
+                [predicate[0] for predicate in self.predicates]:
+            if index >= self.ncols:
+                raise ValueError('Column %d out of range' % index)
+
+        if not self.query.header:
+            return b''
+        if self.projection:
+            names = [names[index] for index in self.projection]
+        return self.query.delimiter.join(names) + b'\n'
+
+    def _fields(self, buf, starts, length):
+        """
+        The 'length' bytes from starts, as an array of byte strings
+        """
+        positions = starts[:, None] + np.arange(length)
+        return buf[positions].view('S%d' % length).ravel()
+
+    def _compare_strings(self, buf, starts, ends, op, value):
+        """
+        Compare fields with a value. Only the first len(value) + 1 bytes of
+        a field are needed to know its order, and the fields are grouped by
+        the length compared, so the work is bounded by the field bytes.
+        """
+        lengths = np.minimum(ends - starts, len(value) + 1)
+        result = np.empty(len(starts), dtype=bool)
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            if length:
+                result[rows] = op(self._fields(buf, starts[rows], length),
+                                  value)
+            else:
+                result[rows] = op(b'', value)
+        return result
+
+    def _parse_numbers(self, buf, starts, ends):
+        """
+        Fields as floats, grouped by length. Fields that are not numbers
+        (i.e. empty fields) are NaN.
+        """
+        lengths = ends - starts
+        numbers = np.full(len(starts), np.nan)
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            if not length:
+                continue
+            if length > NUMBER_WIDTH:
+                for row in rows:
+                    number = _to_number(
+                        buf[starts[row]:ends[row]].tobytes())
+                    if number is not None:
+                        numbers[row] = number
+                continue
+            numbers[rows] = _to_numbers(self._fields(buf, starts[rows],
+                                                     length))
+        return numbers
+
+    def _gather(self, buf, starts, ends):
+        """
+        Concatenate the fields of each row, separated by the delimiter and
+        ended by a newline. starts and ends are (rows, fields) arrays.
+        """
+        lengths = (ends - starts + 1).ravel()
+        if not len(lengths):
+            return b''
+        offsets = np.cumsum(lengths)
+        positions = np.repeat(starts.ravel() - (offsets - lengths),
+                              lengths) + np.arange(offsets[-1])
+        out = buf[positions]
+        separators = np.full(starts.shape, self.delimiter, dtype=np.uint8)
+        separators[:, -1] = NEWLINE
+        out[offsets - 1] = separators.ravel()
+        return out.tobytes()
+
+    def _filter_rows(self, data):
+        """
+        Filter a block of complete rows, each one ended by a newline
+        """
+        buf = np.frombuffer(data, dtype=np.uint8)
+        row_ends = np.flatnonzero(buf == NEWLINE)
+        row_starts = np.concatenate(([0], row_ends[:-1] + 1))
+        delimiters = np.flatnonzero(buf == self.delimiter)
+
+        # Rows with other number of fields do not meet the query
+        first = np.searchsorted(delimiters, row_starts)
+        counts = np.searchsorted(delimiters, row_ends) - first
+        valid = counts == self.ncols - 1
+        row_starts, row_ends, first = \
+            row_starts[valid], row_ends[valid], first[valid]
+        if not len(row_starts):
+            return b''
+
+        # Field boundaries of the valid rows
+        field_starts = np.empty((len(row_starts), self.ncols), dtype=np.intp)
+        field_ends = np.empty((len(row_starts), self.ncols), dtype=np.intp)
+        field_starts[:, 0] = row_starts
+        field_ends[:, -1] = row_ends - (buf[row_ends - 1] == CARRIAGE_RETURN)
+        if self.ncols > 1:
+            positions = delimiters[first[:, None] + np.arange(self.ncols - 1)]
+            field_starts[:, 1:] = positions + 1
+            field_ends[:, :-1] = positions
+
+        # Each predicate is only evaluated on the rows that meet the
+        # previous ones
+        selected = np.arange(len(row_starts))
+        for column, op, value, number in self.predicates:
+            starts = field_starts[selected, column]
+            ends = field_ends[selected, column]
+            if number is not None:
+                # Fields that are not numbers never meet the predicate
+                numbers = self._parse_numbers(buf, starts, ends)
+                selected = selected[~np.isnan(numbers) & op(numbers, number)]
+            else:
+                selected = selected[self._compare_strings(buf, starts, ends,
+                                                          op, value)]
+            if not len(selected):
+                return b''
+
+        if self.projection:
+            return self._gather(buf, field_starts[selected][:, self.projection],
+                                field_ends[selected][:, self.projection])
+        return self._gather(buf, row_starts[selected, None],
+                            row_ends[selected, None])
+
+    def _chunks(self):
+        if hasattr(self.obj_data, 'read'):
+            return iter(lambda: self.obj_data.read(READ_CHUNK_SIZE), b'')
+        return iter(self.obj_data)
+
+    def _read(self):
+        for chunk in self._chunks():
+            data = self.tail + chunk
+            end = data.rfind(b'\n') + 1
+            self.tail = data[end:]
+            data = data[:end]
+
+            if self.columns is None and data:
+                header_end = data.find(b'\n') + 1
+                header = self._bind(data[:header_end - 1])
+                if self.query.header:
+                    data = data[header_end:]
+                if header:
+                    yield header
+
+            if data:
+                rows = self._filter_rows(data)
+                if rows:
+                    yield rows
+
+        if self.tail:
+            # Last row without newline
+            data, self.tail = self.tail + b'\n', b''
+            if self.columns is None:
+                header = self._bind(data[:-1])
+                if header:
+                    yield header
+                if self.query.header:
+                    return
+            rows = self._filter_rows(data)
+            if rows:
+                yield rows
+
+    def next(self):
+        if self._iter is None:
+            self._iter = self._read()
+        return next(self._iter)
+
+    __next__ = next
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += self.next()
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if hasattr(self.obj_data, 'close'):
+            self.obj_data.close()
+
+
+@Singleton
+class CrystalCSVFilter(object):
+    """
+    Native filter that returns only the rows and columns of a CSV object
+    that meet the query of its parameters (see CSVQuery), so the selection
+    is executed next to the data instead of in the client.
+    """
+
+    def __init__(self, filter_conf, global_conf, logger):
+        self.logger = logger
+        self.filter_conf = filter_conf
+        self.global_conf = global_conf
+        # Parsed queries by filter parameters
+        self.queries = dict()
+
+    def _get_query(self, params):
+        query = self.queries.get(params)
+        if query is None:
+            query = CSVQuery(params)
+            if len(self.queries) >= 1000:
+                self.queries.clear()
+            self.queries[params] = query
+        return query
+
+    def execute(self, req_resp, crystal_iter, request_data):
+        if crystal_iter is None:
+            if isinstance(req_resp, Request):
+                crystal_iter = req_resp.environ['wsgi.input']
+            else:
+                crystal_iter = req_resp.app_iter
+
+        query = self._get_query(request_data.get('params') or '')
+        if not isinstance(req_resp, Request):
+            # The filtered body is not the stored object anymore
+            req_resp.headers.pop('ETag', None)
+
+        self.logger.info('Crystal Filters - Selecting rows of ' +
+                         request_data['account'] + '/' +
+                         request_data['container'] + '/' +
+                         request_data['object'])
+        return CSVFilterIter(crystal_iter, query, self.logger)
@@ -0,0 +1,159 @@
+from eventlet.event import Event
+from eventlet import Timeout
+import time
+
+
+class FilterFlight(object):
+    """
+    Output of a filter pipeline shared by concurrent GETs. Only the last
+    chunks that fit in 'max_bytes' are kept, and at least the last one.
+    """
+
+    def __init__(self, headers, max_bytes):
+        self.headers = headers
+        self.max_bytes = max_bytes
+        self.chunks = []
+        # Bytes of the chunks in the buffer
+        self.size = 0
+        # Index of the first chunk in the buffer
+        self.base = 0
+        self.done = False
+        self.failed = False
+        self.updated = time.time()
+        self.event = Event()
+
+    def can_join(self, timeout):
+        """
+        A new request can only join while the first chunk is in the buffer,
+        and the pipeline is not stalled
+        """
+        return (not self.failed and self.base == 0 and
+                (self.done or time.time() - self.updated < timeout))
+
+    def _wake_up(self):
+        event, self.event = self.event, Event()
+        event.send()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while self.size > self.max_bytes and len(self.chunks) > 1:
+            self.size -= len(self.chunks.pop(0))
+            self.base += 1
+        self.updated = time.time()
+        self._wake_up()
+
+    def finish(self):
+        self.done = True
+        self._wake_up()
+
+    def abort(self):
+        self.failed = True
+        self._wake_up()
+
+
+class CrystalGetCoalescer(object):
+    """
+    Single-flight execution of the GET filter pipelines of the object
+    server.
+
+    The first GET of an object (key) runs the pipeline, and its output is
+    fanned out to the concurrent GETs of the same key through a buffer of
+    'coalesce_buffer_bytes'. A request that falls behind the buffer, or
+    that waits more than 'coalesce_wait_timeout' seconds for the next
+    chunk, runs its own pipeline and skips the data already sent, so the
+    filters must be deterministic.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.buffer_bytes = int(conf.get('coalesce_buffer_bytes', 8388608))
+        self.wait_timeout = float(conf.get('coalesce_wait_timeout', 1))
+        self.flights = dict()
+
+    def _lead(self, key, flight, app_iter):
+        try:
+            for chunk in app_iter:
+                flight.publish(chunk)
+                yield chunk
+            flight.finish()
+        finally:
+            if not flight.done:
+                flight.abort()
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _follow(self, flight, resp, object_iter, run_filters):
+        index = 0
+        sent = 0
+        fallback = False
+
+        try:
+            while index >= flight.base:
+                if index < flight.base + len(flight.chunks):
+                    chunk = flight.chunks[index - flight.base]
+                    index += 1
+                    sent += len(chunk)
+                    yield chunk
+                    continue
+                if flight.done:
+                    return
+                if flight.failed:
+                    break
+
+                event = flight.event
+                progressed = False
+                with Timeout(self.wait_timeout, False):
+                    event.wait()
+                    progressed = True
+                if not progressed:
+                    break
+            fallback = True
+        finally:
+            if not fallback and hasattr(object_iter, 'close'):
+                object_iter.close()
+
+        # Fall back to the own execution of the pipeline
+        self.logger.info('Crystal Filters - Coalesced GET fell behind, '
+                         'executing its own filters')
+        resp.app_iter = object_iter
+        app_iter = run_filters(resp).app_iter
+        try:
+            for chunk in app_iter:
+                if sent >= len(chunk):
+                    sent -= len(chunk)
+                    continue
+                if sent:
+                    chunk = chunk[sent:]
+                    sent = 0
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def execute(self, key, resp, run_filters):
+        """
+        Execute the filters of a GET response, or join the execution of a
+        concurrent GET with the same key
+        :param key: (path, stored etag, filter plan hash) tuple
+        :param resp: object server GET response
+        :param run_filters: function that executes the filters on resp
+        :returns: the response with the filtered app_iter
+        """
+        flight = self.flights.get(key)
+        if flight and flight.can_join(self.wait_timeout):
+            self.logger.debug('Crystal Filters - Joining the filter '
+                              'execution of ' + key[0])
+            resp.headers.clear()
+            resp.headers.update(flight.headers)
+            resp.app_iter = self._follow(flight, resp, resp.app_iter,
+                                         run_filters)
+            return resp
+
+        resp = run_filters(resp)
+        flight = FilterFlight(dict(resp.headers), self.buffer_bytes)
+        self.flights[key] = flight
+        resp.app_iter = self._lead(key, flight, resp.app_iter)
+        return resp
@@ -4,20 +4,164 @@
 from swift.common.exceptions import DiskFileNotExist
 from swift.common.exceptions import DiskFileXattrNotSupported
 from swift.common.exceptions import DiskFileNoSpace
-from swift.obj.diskfile import _get_filename
+import mimetypes
+import posixpath
+import hashlib
+import json
 import operator
 import logging
 import pickle
+import ctypes
 import errno
 import xattr
 
 PICKLE_PROTOCOL = 2
 METADATA_KEY = 'user.swift.iostack'
+ORIGINAL_ETAG_SYSMETA = 'X-Object-Sysmeta-Crystal-Original-Etag'
+ORIGINAL_SIZE_SYSMETA = 'X-Object-Sysmeta-Crystal-Original-Size'
+PLAN_HASH_SYSMETA = 'X-Object-Sysmeta-Crystal-Plan-Hash'
+# swift.source of the requests of crystal-refilter. Its GETs read the stored
+# data, only with the reverse filters of the object applied.
+REFILTER_SOURCE = 'CrystalRefilter'
+# Object server allowed headers kept when an object is rewritten
+COPIED_HEADERS = ('content-encoding', 'content-disposition', 'x-delete-at')
 
 mappings = {'>': operator.gt, '>=': operator.ge,
             '==': operator.eq, '<=': operator.le, '<': operator.lt,
             '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
 
+# Copies of the MIME maps, loaded once on the middleware load (before the
+# workers fork) instead of on the first guess of each worker.
+mimetypes.init()
+_MIME_TYPES = dict(mimetypes.types_map)
+_MIME_ENCODINGS = dict(mimetypes.encodings_map)
+_MIME_SUFFIXES = dict(mimetypes.suffix_map)
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+_posix_fadvise = None
+
+
+def plan_hash(filter_exec_list, include_global=False):
+    """
+    Hash of a filter execution list, to know if an object has been stored
+    with the current policies. By default global filters are not part of
+    the plan, as they do not change the stored data.
+    :param filter_exec_list: filter execution list
+    :param include_global: whether global filters are part of the plan
+    :returns: the hash, or an empty string if there are no filters
+    """
+    plan = dict((str(key), value) for key, value in filter_exec_list.items()
+                if include_global or value['type'] != 'global')
+    if not plan:
+        return ''
+    return hashlib.md5(json.dumps(plan, sort_keys=True)).hexdigest()
+
+
+def guess_object_type(path):
+    """
+    Guess the MIME type of an object from its name, as mimetypes.guess_type
+    :param path: object path
+    :returns: the MIME type, or None if it is unknown
+    """
+    base, ext = posixpath.splitext(path)
+    while ext in _MIME_SUFFIXES:
+        base, ext = posixpath.splitext(base + _MIME_SUFFIXES[ext])
+    if ext in _MIME_ENCODINGS:
+        base, ext = posixpath.splitext(base)
+    return _MIME_TYPES.get(ext, _MIME_TYPES.get(ext.lower()))
+
+
+class ChecksumInput(object):
+    """
+    File-like wrapper that computes the MD5 of the data read through it
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.md5 = hashlib.md5()
+        self._iter = None
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        self.md5.update(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        line = self.source.readline(size)
+        self.md5.update(line)
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iter is None:
+            self._iter = iter(self.source)
+        chunk = next(self._iter)
+        self.md5.update(chunk)
+        return chunk
+
+    __next__ = next
+
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def _get_filename(fd):
+    # The object server diskfile module is only needed in the error paths
+    from swift.obj.diskfile import _get_filename
+    return _get_filename(fd)
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise() on a file descriptor, loaded from libc as Swift does
+    for drop_buffer_cache(), since Python 2 has no os.posix_fadvise
+    :param length: number of bytes, 0 means until the end of the file
+    :returns: True if the advice has been applied
+    """
+    global _posix_fadvise
+    if _posix_fadvise is None:
+        from swift.common.utils import load_libc_function
+        _posix_fadvise = load_libc_function('posix_fadvise64')
+    ret = _posix_fadvise(fd, ctypes.c_uint64(offset),
+                         ctypes.c_uint64(length), advice)
+    if ret:
+        logging.warning('posix_fadvise64(%s, %s, %s, %s) -> %s' %
+                        (fd, offset, length, advice, ret))
+    return not ret
+
+
+def read_ahead(resp, chunk_size, readahead_size):
+    """
+    Prepare an object server GET response to be read sequentially by the
+    filters: the disk file reader reads chunk_size bytes at a time, and the
+    kernel is asked to read ahead the object data file
+    :param resp: object server GET response
+    :param chunk_size: bytes per disk read, or 0 to keep the default
+    :param readahead_size: bytes to prefetch, 0 means the whole object
+    :returns: True if the response is read from a disk file
+    """
+    reader = resp.app_iter
+    fp = getattr(reader, '_fp', None)
+    if fp is None:
+        # Not a disk file reader (i.e. range requests)
+        return False
+
+    if chunk_size:
+        reader._disk_chunk_size = chunk_size
+
+    fd = fp.fileno()
+    offset = fp.tell()
+    fadvise(fd, offset, 0, POSIX_FADV_SEQUENTIAL)
+    fadvise(fd, offset, readahead_size, POSIX_FADV_WILLNEED)
+    return True
+
 
 def read_metadata(fd, md_key=None):
     """
@@ -93,9 +237,18 @@ def put_metadata(app, req, crystal_md):
     fd = get_resp.app_iter._fp
     file_path = get_resp.app_iter._data_file.rsplit('/', 1)[0]
 
+    # MD5 of the original data, computed by the proxy while it was received
+    original_etag = get_resp.headers.get(ORIGINAL_ETAG_SYSMETA)
+    if original_etag:
+        crystal_md['original-etag'] = original_etag
+
     for key in crystal_md["filter-exec-list"].keys():
         cfilter = crystal_md["filter-exec-list"][key]
         if cfilter['type'] != 'global' and cfilter['has_reverse']:
+            if 'execution_server_reverse' not in cfilter:
+                # Already prepared for the reverse execution (i.e. filters
+                # read back from the object when merging deferred filters)
+                continue
             current_params = cfilter['params']
             if current_params:
                 cfilter['params'] = current_params+','+'reverse=True'
@@ -1,4 +1,3 @@
-import crystal_filter_storlet_gateway as storlet_gateway
 from swift.common.swob import Request
 import json
 
@@ -30,7 +29,7 @@ class Singleton:
         On all subsequent calls, the already created instance is returned.
 
         """
-        logger = args['log']
+        logger = args.get('log', args.get('logger'))
         try:
             if self._instance:
                 logger.info("Crystal - Singleton instance of filter"
@@ -55,10 +54,13 @@ class CrystalFilterControl():
         self.logger = log
         self.conf = conf
         self.server = self.conf.get('execution_server')
-
+        self.deferred_worker = None
+        self.coalescer = None
 
     def _setup_storlet_gateway(self, conf, logger, request_data):
         ''' Setup the Storlet Gateway '''
+        # Loaded on the first storlet execution, not on the middleware load
+        import crystal_filter_storlet_gateway as storlet_gateway
         return storlet_gateway.SDSGatewayStorlet(conf, logger, request_data)
         
     def _load_native_filter(self, filter_data):
@@ -72,6 +74,28 @@ class CrystalFilterControl():
         
         return metric_class
             
+    def _get_deferred_worker(self):
+        if not self.deferred_worker:
+            from crystal_filter_deferred import CrystalDeferredWorker
+            self.deferred_worker = CrystalDeferredWorker(self.conf,
+                                                         self.logger, self)
+        return self.deferred_worker
+
+    def defer_filters(self, app, req):
+        ''' Queue the deferred filters of a just stored object '''
+        return self._get_deferred_worker().enqueue(app, req)
+
+    def resume_deferred_filters(self, app):
+        ''' Start the worker of the deferred filters saved in the devices '''
+        self._get_deferred_worker().start(app)
+
+    def coalesce_filters(self, key, resp, run_filters):
+        ''' Single-flight execution of the GET filters of an object '''
+        if not self.coalescer:
+            from crystal_filter_coalescer import CrystalGetCoalescer
+            self.coalescer = CrystalGetCoalescer(self.conf, self.logger)
+        return self.coalescer.execute(key, resp, run_filters)
+
     def execute_filters(self, req_resp, filter_exec_list, app,
                         api_version, account, container, obj, method):
         
@@ -107,8 +131,13 @@ class CrystalFilterControl():
                     self.logger.info('Crystal Filters - Go to execute native '
                                      'Filter: '+ filter_data['main'])
                     native_filter = self._load_native_filter(filter_data)
+                    # Native filters are singletons, so the parameters of
+                    # each stage go with the request data
+                    filter_request_data = dict(requets_data)
+                    filter_request_data['params'] = filter_data.get('params',
+                                                                    '')
                     app_iter = native_filter.execute(req_resp, app_iter, 
-                                                     requets_data)
+                                                     filter_request_data)
                     filter_executed = True
                     
             else:
@@ -0,0 +1,254 @@
+from swift.common.swob import Request
+from swift.common.utils import FileLikeIter
+from swift.common.utils import Timestamp
+from swift.common.http import is_success
+from swift.common.http import HTTP_NOT_FOUND
+from swift.common.http import HTTP_CONFLICT
+from eventlet.queue import LightQueue
+from eventlet.queue import Full
+try:
+    from swift.common.utils import write_pickle
+except ImportError:
+    # Newer Swift versions
+    from swift.common.utils.pickle import write_pickle
+import crystal_filter_common as sc
+import eventlet
+import hashlib
+import pickle
+import fcntl
+import errno
+import os
+
+DEFERRED_DIR = 'crystal_deferred'
+
+# Headers of the client PUT kept in the jobs: the storage policy, and the
+# container to update with the filtered object
+JOB_HEADERS = ('X-Backend-Storage-Policy-Index', 'X-Container-Host',
+               'X-Container-Device', 'X-Container-Partition')
+
+
+class CrystalDeferredWorker(object):
+    """
+    Background worker that applies the deferred PUT filters on the object
+    server.
+
+    The raw object is stored by the client PUT with a 'deferred-exec-list'
+    marker in its Crystal metadata. Each job only carries the object path,
+    the rest is read back from the object, so a job for an object that has
+    been overwritten in the meantime is simply discarded.
+
+    As the async pendings of the object server, the jobs are saved in the
+    'crystal_deferred' directory of the device of the object, and removed
+    once they are done. The directories are scanned at start and every
+    'deferred_scan_interval' seconds, so the jobs left by a restart, a
+    full queue or a failed execution are queued again.
+    """
+
+    def __init__(self, conf, logger, filter_control):
+        self.conf = conf
+        self.logger = logger
+        self.filter_control = filter_control
+        self.devices = conf.get('devices', '/srv/node')
+        self.scan_interval = float(conf.get('deferred_scan_interval', 300))
+        self.queue = LightQueue(int(conf.get('deferred_queue_size', 1000)))
+        # Job files in the queue
+        self.queued = set()
+        self.app = None
+        self.worker = None
+
+    def start(self, app):
+        """
+        Start the worker and the scan of the saved jobs
+        :param app: the object server application
+        """
+        if not self.worker:
+            # Spawned lazily to start the greenthreads after the fork
+            self.app = app
+            self.worker = eventlet.spawn(self._run)
+            eventlet.spawn(self._scan_forever)
+
+    def enqueue(self, app, req):
+        """
+        Save and queue a deferred filter job for the object stored by req
+
+        :param app: the object server application
+        :param req: the object server PUT request
+        :returns: True if the job has been saved, False otherwise
+        """
+        self.start(app)
+
+        headers = {'X-Timestamp': req.headers['X-Timestamp']}
+        for header in JOB_HEADERS:
+            if header in req.headers:
+                headers[header] = req.headers[header]
+        job = {'path': req.path, 'headers': headers}
+
+        device = req.path.split('/')[1]
+        job_name = hashlib.md5(req.path).hexdigest() + '-' + \
+            Timestamp(headers['X-Timestamp']).internal
+        job_file = os.path.join(self.devices, device, DEFERRED_DIR, job_name)
+        try:
+            write_pickle(job, job_file,
+                         os.path.join(self.devices, device, 'tmp'),
+                         sc.PICKLE_PROTOCOL)
+        except (IOError, OSError):
+            self.logger.exception('Crystal Filters - Error saving deferred '
+                                  'job, object ' + req.path +
+                                  ' stays unfiltered')
+            return False
+
+        self._queue_job(job_file)
+        return True
+
+    def _queue_job(self, job_file):
+        if job_file in self.queued:
+            return True
+        try:
+            self.queue.put_nowait(job_file)
+        except Full:
+            self.logger.warning('Crystal Filters - Deferred queue is full, '
+                                'job ' + job_file + ' left for the next scan')
+            return False
+        self.queued.add(job_file)
+        return True
+
+    def _scan(self):
+        try:
+            devices = os.listdir(self.devices)
+        except OSError:
+            return
+        for device in devices:
+            job_dir = os.path.join(self.devices, device, DEFERRED_DIR)
+            try:
+                job_names = os.listdir(job_dir)
+            except OSError:
+                continue
+            for job_name in job_names:
+                if not self._queue_job(os.path.join(job_dir, job_name)):
+                    return
+
+    def _scan_forever(self):
+        while True:
+            try:
+                self._scan()
+            except Exception:
+                self.logger.exception('Crystal Filters - Error scanning '
+                                      'deferred jobs')
+            eventlet.sleep(self.scan_interval)
+
+    def _run(self):
+        while True:
+            job_file = self.queue.get()
+            try:
+                self._process_job(job_file)
+            except Exception:
+                self.logger.exception('Crystal Filters - Deferred filter '
+                                      'execution failed on ' + job_file)
+            finally:
+                self.queued.discard(job_file)
+
+    def _process_job(self, job_file):
+        try:
+            fp = open(job_file, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # Already done
+                return
+            raise
+
+        with fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Being processed by another object server worker
+                return
+            if not os.path.exists(job_file):
+                return
+
+            job = pickle.load(fp)
+            if self._apply_deferred_filters(self.app, job['path'],
+                                            job['headers']):
+                os.unlink(job_file)
+
+    def _apply_deferred_filters(self, app, path, headers):
+        """
+        :returns: True if the job is done, False to retry it later
+        """
+        get_headers = dict()
+        if 'X-Backend-Storage-Policy-Index' in headers:
+            get_headers['X-Backend-Storage-Policy-Index'] = \
+                headers['X-Backend-Storage-Policy-Index']
+        get_req = Request.blank(path, environ={'REQUEST_METHOD': 'GET'},
+                                headers=get_headers)
+        get_resp = get_req.get_response(app)
+
+        if get_resp.status_int == HTTP_NOT_FOUND:
+            self.logger.info('Crystal Filters - Deferred object ' + path +
+                             ' not found')
+            return True
+        if not is_success(get_resp.status_int):
+            self.logger.error('Crystal Filters - Error reading deferred '
+                              'object ' + path + ': ' + get_resp.status)
+            return False
+
+        crystal_md = sc.get_metadata(get_resp)
+        timestamp = Timestamp(headers['X-Timestamp'])
+        # X-Timestamp is in normal form, without the offset
+        stored_timestamp = Timestamp(get_resp.headers['X-Backend-Timestamp'])
+        if stored_timestamp != timestamp or \
+                not crystal_md.get('deferred-exec-list'):
+            # The object has been overwritten or already filtered
+            get_resp.app_iter.close()
+            return True
+
+        _, _, account, container, obj = get_req.split_path(5, 5, True)
+        deferred_list = crystal_md.pop('deferred-exec-list')
+        for filter_data in deferred_list.values():
+            filter_data['execution_server'] = self.filter_control.server
+
+        # The offset keeps the same timestamp in all the replicas, and
+        # makes any newer client write win over the filtered object. The
+        # container headers update the listing with the filtered object.
+        put_headers = dict(headers)
+        put_headers['X-Timestamp'] = Timestamp(timestamp, offset=1).internal
+        put_headers['Content-Type'] = get_resp.headers['Content-Type']
+        for key, value in get_resp.headers.items():
+            if key.lower().startswith(('x-object-meta-',
+                                       'x-object-sysmeta-')) or \
+                    key.lower() in sc.COPIED_HEADERS:
+                put_headers[key] = value
+
+        if not crystal_md['original-etag']:
+            crystal_md['original-etag'] = get_resp.headers['ETag']
+
+        put_req = Request.blank(path,
+                                environ={'REQUEST_METHOD': 'PUT',
+                                         'wsgi.input':
+                                         FileLikeIter(get_resp.app_iter)},
+                                headers=put_headers)
+
+        self.logger.info('Crystal Filters - Go to execute deferred filters '
+                         'on ' + path)
+        put_req = self.filter_control.execute_filters(put_req, deferred_list,
+                                                      app, '0', account,
+                                                      container, obj, 'put')
+        if 'CONTENT_LENGTH' in put_req.environ:
+            put_req.environ.pop('CONTENT_LENGTH')
+        put_req.headers['Transfer-Encoding'] = 'chunked'
+
+        put_resp = put_req.get_response(app)
+        if put_resp.status_int == HTTP_CONFLICT:
+            # Already stored by a previous execution
+            return True
+        if not is_success(put_resp.status_int):
+            self.logger.error('Crystal Filters - Error storing deferred '
+                              'filtered object ' + path + ': ' +
+                              put_resp.status)
+            return False
+
+        crystal_md['stored-etag'] = put_resp.headers.get('ETag')
+        crystal_md['filter-exec-list'].update(deferred_list)
+        if not sc.put_metadata(app, put_req, crystal_md):
+            self.logger.error('Crystal Filters - Error writing metadata in '
+                              'deferred filtered object ' + path)
+        return True
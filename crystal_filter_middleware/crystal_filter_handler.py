@@ -7,16 +7,22 @@
 from swift.proxy.controllers.base import get_account_info
 from swift.common.swob import HTTPInternalServerError
 from swift.common.swob import HTTPException
+from swift.common.swob import HTTPUnprocessableEntity
 from swift.common.swob import wsgify
+from swift.common.http import is_success
 from swift.common.utils import config_true_value
 from swift.common.utils import get_logger
 from crystal_filter_control import CrystalFilterControl
+from crystal_filter_profiler import CrystalProfiler
+from crystal_policy_trie import PolicyTrieCache
 import crystal_filter_common as sc
-import ConfigParser
-import mimetypes
-import redis
 import json
 
+# Storlet gateway configurations already read, by file
+_gateway_confs = dict()
+# Redis connection pools of this process, by (host, port, db)
+_redis_pools = dict()
+
 
 class NotSDSFilterRequest(Exception):
     pass
@@ -70,11 +76,23 @@ class BaseSDSFilterHandler(object):
         self.cache = conf.get('cache')
         
         self.method = self.request.method.lower()
-        
-        self.redis = redis.StrictRedis(self.redis_host, 
-                                                  self.redis_port, 
-                                                  self.redis_db)
-        
+        self._redis = None
+
+    @property
+    def redis(self):
+        """
+        Redis connection, only created by the requests that need it
+        """
+        if self._redis is None:
+            import redis
+            pool_key = (self.redis_host, self.redis_port, self.redis_db)
+            if pool_key not in _redis_pools:
+                _redis_pools[pool_key] = redis.ConnectionPool(
+                    host=self.redis_host, port=self.redis_port,
+                    db=self.redis_db)
+            self._redis = redis.StrictRedis(
+                connection_pool=_redis_pools[pool_key])
+        return self._redis
 
     def _extract_vaco(self):
         """
@@ -190,35 +208,31 @@ class BaseSDSFilterHandler(object):
 
 class SDSFilterProxyHandler(BaseSDSFilterHandler):
 
-    def __init__(self, request, conf, app, logger, filter_control):        
+    def __init__(self, request, conf, app, logger, filter_control,
+                 policy_cache):
         super(SDSFilterProxyHandler, self).__init__(request, conf, 
                                                     app, logger,
                                                     filter_control)
 
-        # Dynamic binding of policies
-        account_key_list = self.redis.keys("pipeline:"+
-                                                      str(self.account)+ 
-                                                      "*")
-
         self.global_filters = self.redis.hgetall('global_filters')
         
+        # Dynamic binding of policies: the most specific target among the
+        # account, container, pseudo-directories and object
         self.filter_list = None
         key = self.account + "/" + self.container + "/" + self.obj
-        for target in range(3):
-            self.target_key = key.rsplit("/", target)[0]
-            if 'pipeline:' + self.target_key in account_key_list:
-                self.filter_list = self.redis.hgetall(
-                    'pipeline:' + self.target_key)
-                break
+        self.target_key = policy_cache.lookup(self.redis, self.account, key)
+        if self.target_key:
+            self.filter_list = self.redis.hgetall(
+                'pipeline:' + self.target_key)
 
     def _parse_vaco(self):
         return self.request.split_path(4, 4, rest_with_last=True)
 
     def _get_object_type(self):
-        object_type = self.request.headers['Content-Type']
+        object_type = self.request.headers.get('Content-Type')
         if not object_type:
-            object_type = mimetypes.guess_type(
-                self.request.environ['PATH_INFO'])[0]
+            object_type = sc.guess_object_type(
+                self.request.environ['PATH_INFO'])
         return object_type
 
     def is_proxy_runnable(self, resp):
@@ -283,7 +297,7 @@ class SDSFilterProxyHandler(BaseSDSFilterHandler):
                 filter_execution_list[int(key)] = filter_execution
         
         ''' Parse filter list '''
-        for _, filter_metadata in self.filter_list.items():            
+        for _, filter_metadata in (self.filter_list or {}).items():
             filter_metadata = json.loads(filter_metadata)
   
             # Check conditions
@@ -294,11 +308,13 @@ class SDSFilterProxyHandler(BaseSDSFilterHandler):
                     reverse = filter_metadata["execution_server_reverse"]
                     params = filter_metadata["params"]
                     filter_id = filter_metadata["filter_id"]
-                    filter_type = 'storlet' #filter_metadata["filter_type"]
+                    filter_type = filter_metadata.get("filter_type", 'storlet')
                     filter_main = filter_metadata["main"]
                     filter_dependencies = filter_metadata["dependencies"]
                     filter_size = filter_metadata["content_length"]
                     has_reverse = filter_metadata["has_reverse"]
+                    deferred = config_true_value(
+                        filter_metadata.get("deferred", False))
                     
                     filter_execution = {'name': filter_name,
                                         'params': params,
@@ -309,19 +325,73 @@ class SDSFilterProxyHandler(BaseSDSFilterHandler):
                                         'main': filter_main,
                                         'dependencies': filter_dependencies,
                                         'size': filter_size,
-                                        'has_reverse': has_reverse}
+                                        'has_reverse': has_reverse,
+                                        'deferred': deferred}
                    
                     launch_key = filter_metadata["execution_order"]
                     filter_execution_list[launch_key] = filter_execution
         
         return filter_execution_list
 
+    def _split_deferred_filters(self, filter_exec_list):
+        """
+        Split the filter execution list in the filters to execute within the
+        PUT request and the filters deferred to the object server background
+        worker. All the filters after the first deferred one are also
+        deferred to keep the execution order. Global filters are always
+        executed within the request.
+        """
+        inline_list = dict()
+        deferred_list = dict()
+
+        for key in sorted(filter_exec_list):
+            filter_data = filter_exec_list[key]
+            if filter_data['type'] != 'global' and \
+                    (deferred_list or filter_data['deferred']):
+                deferred_list[key] = filter_data
+            else:
+                inline_list[key] = filter_data
+
+        return inline_list, deferred_list
+
+    def _set_checksum_footers(self, original_input, stored_input):
+        """
+        Send the MD5 of the original data as object metadata footer, once it
+        is entirely read, and reject the PUT if it does not match the ETag
+        sent by the client. If all the filters have been executed in the
+        proxy, the MD5 of the filtered data is also sent as ETag footer, so
+        the object servers verify the data they receive.
+        """
+        client_etag = self.request.headers.get('Original-Etag')
+        inner_callback = self.request.environ.get(
+            'swift.callback.update_footers', lambda footers: None)
+
+        def footers_callback(footers):
+            inner_callback(footers)
+
+            original_etag = original_input.hexdigest()
+            if client_etag and client_etag.strip('"').lower() != original_etag:
+                self.logger.error('Crystal Filters - ETag mismatch in ' +
+                                  self.request.path)
+                raise HTTPUnprocessableEntity(request=self.request)
+            footers[sc.ORIGINAL_ETAG_SYSMETA] = original_etag
+
+            if stored_input and 'Etag' not in footers:
+                footers['Etag'] = stored_input.hexdigest()
+
+        self.request.environ['swift.callback.update_footers'] = \
+            footers_callback
+
     def GET(self):
         """
         GET handler on Proxy
         """    
         
-        if self.global_filters or self.filter_list:
+        if self.request.environ.get('swift.source') == sc.REFILTER_SOURCE:
+            # Data read to be stored again, no GET filters must be applied
+            self.logger.debug('Crystal Filters - Refilter GET, skipping '
+                              'the GET filters')
+        elif self.global_filters or self.filter_list:
             self.app.logger.info('Crystal Filters - There are Filters to execute')
             filter_exec_list = self._build_filter_execution_list()
             self.request.headers['CRYSTAL-FILTERS'] = json.dumps(filter_exec_list)
@@ -344,17 +414,48 @@ class SDSFilterProxyHandler(BaseSDSFilterHandler):
             self.app.logger.info('Crystal Filters - There are Filters to execute')
             filter_exec_list = self._build_filter_execution_list()
             if filter_exec_list:
+                # Stored in the object to know its current policies
+                self.request.headers[sc.PLAN_HASH_SYSMETA] = \
+                    sc.plan_hash(filter_exec_list)
+                if self.request.headers.get('Content-Length'):
+                    self.request.headers[sc.ORIGINAL_SIZE_SYSMETA] = \
+                        self.request.headers['Content-Length']
+
+                filter_exec_list, deferred_list = \
+                    self._split_deferred_filters(filter_exec_list)
                 self.request.headers['Filter-Executed-List'] = json.dumps(filter_exec_list)
                 self.request.headers['Original-Size'] = self.request.headers.get('Content-Length','')
                 self.request.headers['Original-Etag'] = self.request.headers.get('ETag','')
-                
-                if 'ETag' in self.request.headers:
-                    # The object goes to be modified by some Storlet, so we
-                    # delete the Etag from request headers to prevent checksum
-                    # verification.
-                    self.request.headers.pop('ETag')
 
-                self.apply_filters_on_put(filter_exec_list)
+                original_input = sc.ChecksumInput(
+                    self.request.environ['wsgi.input'])
+                self.request.environ['wsgi.input'] = original_input
+
+                if deferred_list:
+                    # The raw object is stored now, and the deferred filters
+                    # are executed later by the object server worker.
+                    self.logger.info('Crystal Filters - Deferring filters '
+                                     'to the object server')
+                    self.request.headers['Filter-Deferred-List'] = json.dumps(deferred_list)
+
+                if filter_exec_list:
+                    if 'ETag' in self.request.headers:
+                        # The object goes to be modified by some Storlet, so we
+                        # delete the Etag from request headers to prevent checksum
+                        # verification.
+                        self.request.headers.pop('ETag')
+
+                    self.apply_filters_on_put(filter_exec_list)
+
+                stored_input = None
+                if 'CRYSTAL-FILTERS' not in self.request.headers:
+                    # No filters left for the object server
+                    stored_input = self.request.environ['wsgi.input']
+                    if stored_input is not original_input:
+                        stored_input = sc.ChecksumInput(stored_input)
+                        self.request.environ['wsgi.input'] = stored_input
+
+                self._set_checksum_footers(original_input, stored_input)
 
             else:
                 self.logger.info('Crystal Filters - No filters to execute')
@@ -413,12 +514,31 @@ class SDSFilterObjectHandler(BaseSDSFilterHandler):
         
         return new_storlet_list
 
-    def _set_crystal_metadata(self):
+    def _is_coalescible(self, filter_list):
+        """
+        GETs can share the execution of the filters unless they are range
+        requests, or there are global filters to execute here, which are
+        executed per request
+        """
+        if not config_true_value(self.conf.get('coalesce_gets')) or \
+                self.is_range_request:
+            return False
+        return not any(filter_data['type'] == 'global' and
+                       filter_data['execution_server'] == self.server
+                       for filter_data in filter_list.values())
+
+    def _set_crystal_metadata(self, resp):
         iostack_md = {}
         filter_exec_list = json.loads(self.request.headers['Filter-Executed-List'])
         iostack_md["original-etag"] = self.request.headers['Original-Etag']
         iostack_md["original-size"] = self.request.headers['Original-Size']
+        # MD5 of the stored data, computed by Swift as it leaves the filters
+        iostack_md["stored-etag"] = resp.headers.get('ETag')
         iostack_md["filter-exec-list"] = filter_exec_list
+        if 'Filter-Deferred-List' in self.request.headers:
+            # Marker of the filters still pending to be executed
+            iostack_md["deferred-exec-list"] = json.loads(
+                self.request.headers['Filter-Deferred-List'])
 
         return iostack_md
 
@@ -436,6 +556,7 @@ class SDSFilterObjectHandler(BaseSDSFilterHandler):
 
         if (resp.status_int == 200 or resp.status_int == 201):
             iostack_md = sc.get_metadata(resp)
+            stored_etag = resp.headers.get('ETag')
             
             if iostack_md:
                 resp.headers['ETag'] = iostack_md['original-etag']
@@ -445,6 +566,16 @@ class SDSFilterObjectHandler(BaseSDSFilterHandler):
                                      iostack_md.get('filter-exec-list',None))
             
             if filter_exec_list:
+                if config_true_value(self.conf.get('filtered_read_ahead')):
+                    sc.read_ahead(resp,
+                                  int(self.conf['filtered_read_chunk_size']),
+                                  int(self.conf['filtered_readahead_size']))
+                if self._is_coalescible(filter_exec_list):
+                    key = (self.request.path, stored_etag,
+                           sc.plan_hash(filter_exec_list, include_global=True))
+                    return self.filter_control.coalesce_filters(
+                        key, resp, lambda resp: self.apply_filters_on_get(
+                            resp, filter_exec_list))
                 return self.apply_filters_on_get(resp, filter_exec_list)
             
         return resp
@@ -467,11 +598,14 @@ class SDSFilterObjectHandler(BaseSDSFilterHandler):
         # in the extended metadata of the object for run reverse-Storlet on 
         # GET requests.
         if 'Filter-Executed-List' in self.request.headers:
-            crystal_metadata = self._set_crystal_metadata()
+            crystal_metadata = self._set_crystal_metadata(original_resp)
             if not sc.put_metadata(self.app, self.request, crystal_metadata):
                 self.app.logger.error('Crystal Filters - Error writing'
                                       'metadata in an object')
                 # TODO: Rise exception writting metadata
+            elif 'deferred-exec-list' in crystal_metadata and \
+                    is_success(original_resp.status_int):
+                self.filter_control.defer_filters(self.app, self.request)
             # We need to restore the original ETAG to avoid checksum 
             # verification of Swift clients
             original_resp.headers['ETag'] = crystal_metadata['original-etag']
@@ -489,12 +623,18 @@ class SDSFilterHandlerMiddleware(object):
         self.containers = [self.conf.get('storlet_container'),
                            self.conf.get('storlet_dependency')]
         self.handler_class = self._get_handler(self.exec_server)
+        self.handler_kwargs = dict()
+        if self.exec_server == 'proxy':
+            self.handler_kwargs['policy_cache'] = PolicyTrieCache(
+                self.conf, self.logger)
         
         ''' Singleton instance of filter control '''
         self.control_class = CrystalFilterControl
         self.filter_control =  self.control_class.Instance(conf = self.conf,
                                                            log = self.logger)
-        
+        self.profiler = CrystalProfiler(self.conf, self.logger)
+        self.deferred_resumed = False
+
     def _get_handler(self, exec_server):
         if exec_server == 'proxy':
             return SDSFilterProxyHandler
@@ -506,10 +646,20 @@ class SDSFilterHandlerMiddleware(object):
 
     @wsgify
     def __call__(self, req):
+        if self.exec_server == 'object' and not self.deferred_resumed:
+            # On the first request, once the worker process has forked
+            self.deferred_resumed = True
+            self.filter_control.resume_deferred_filters(self.app)
+        if self.profiler.is_profiled(req):
+            return self.profiler.profile(self._handle_request, req)
+        return self._handle_request(req)
+
+    def _handle_request(self, req):
         try:
             request_handler = self.handler_class(req, self.conf, 
                                                  self.app, self.logger,
-                                                 self.filter_control)
+                                                 self.filter_control,
+                                                 **self.handler_kwargs)
             self.logger.debug('crystal_filter_handler call in %s: with %s/%s/%s' %
                               (self.exec_server, request_handler.account,
                                request_handler.container,
@@ -529,6 +679,19 @@ class SDSFilterHandlerMiddleware(object):
             raise HTTPInternalServerError(body='Crystal filter middleware execution failed')
 
 
+def _read_gateway_conf(conf_file):
+    """
+    Read the DEFAULT items of the storlet gateway configuration. They are
+    kept, so the file is parsed once before the workers fork.
+    """
+    if conf_file not in _gateway_confs:
+        import ConfigParser
+        configParser = ConfigParser.RawConfigParser()
+        configParser.read(conf_file)
+        _gateway_confs[conf_file] = configParser.items("DEFAULT")
+    return _gateway_confs[conf_file]
+
+
 def filter_factory(global_conf, **local_conf):
     """Standard filter factory to use the middleware with paste.deploy"""
     
@@ -550,12 +713,36 @@ def filter_factory(global_conf, **local_conf):
     crystal_conf['reseller_prefix'] = conf.get('reseller_prefix', 'AUTH')  
     crystal_conf['bind_ip'] = conf.get('bind_ip')
     crystal_conf['bind_port'] = conf.get('bind_port')
-
-
-    configParser = ConfigParser.RawConfigParser()
-    configParser.read(conf.get('storlet_gateway_conf',
-                               '/etc/swift/storlet_docker_gateway.conf'))
-    additional_items = configParser.items("DEFAULT")
+    crystal_conf['deferred_queue_size'] = conf.get('deferred_queue_size',
+                                                   1000)
+    crystal_conf['deferred_scan_interval'] = conf.get(
+        'deferred_scan_interval', 300)
+    crystal_conf['devices'] = conf.get('devices', '/srv/node')
+    crystal_conf['pipeline_cache_ttl'] = conf.get('pipeline_cache_ttl', 5)
+    crystal_conf['coalesce_gets'] = conf.get('coalesce_gets', 'false')
+    crystal_conf['coalesce_buffer_bytes'] = conf.get('coalesce_buffer_bytes',
+                                                     8388608)
+    crystal_conf['coalesce_wait_timeout'] = conf.get('coalesce_wait_timeout',
+                                                     1)
+    crystal_conf['filtered_read_ahead'] = conf.get('filtered_read_ahead',
+                                                   'true')
+    crystal_conf['filtered_read_chunk_size'] = conf.get(
+        'filtered_read_chunk_size', 1048576)
+    crystal_conf['filtered_readahead_size'] = conf.get(
+        'filtered_readahead_size', 8388608)
+    crystal_conf['bandwidth_sync_interval'] = conf.get(
+        'bandwidth_sync_interval', 5)
+    crystal_conf['bandwidth_burst_time'] = conf.get('bandwidth_burst_time', 1)
+
+    crystal_conf['profile_sample_rate'] = conf.get('profile_sample_rate', 0)
+    crystal_conf['profile_dir'] = conf.get('profile_dir',
+                                           '/var/log/swift/crystal_profile')
+    crystal_conf['profile_max_files'] = conf.get('profile_max_files', 100)
+
+
+    additional_items = _read_gateway_conf(
+        conf.get('storlet_gateway_conf',
+                 '/etc/swift/storlet_docker_gateway.conf'))
 
     for key, val in additional_items:
         crystal_conf[key] = val
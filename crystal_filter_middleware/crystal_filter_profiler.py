@@ -0,0 +1,148 @@
+import random
+import time
+import os
+
+PROFILE_HEADER = 'X-Crystal-Profile'
+
+
+class ProfiledIter(object):
+    """
+    Wraps the response app_iter to keep profiling while the filters are
+    executed, since they run lazily as the body is sent to the client
+    """
+
+    def __init__(self, app_iter, profile, on_close):
+        self.app_iter = app_iter
+        self.profile = profile
+        self.on_close = on_close
+        self._iter = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iter is None:
+            self._iter = iter(self.app_iter)
+        self.profile.enable()
+        try:
+            return next(self._iter)
+        finally:
+            self.profile.disable()
+
+    __next__ = next
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.on_close:
+                self.on_close()
+                self.on_close = None
+
+
+class CrystalProfiler(object):
+    """
+    Opt-in cProfile of the Crystal code path of a request. A request is
+    profiled when a reseller admin sends the X-Crystal-Profile header, or
+    when it is picked by the 1 in 'profile_sample_rate' sampling. The
+    profiles are written to 'profile_dir' with a summary of the hottest
+    functions, keeping the last 'profile_max_files' of them.
+
+    Note that cProfile also accounts the greenthreads that run while the
+    profiled request is waiting for I/O. Its hook is set in the OS thread
+    shared by all the greenthreads, so only one request is profiled at a
+    time in a process, and the rest are not profiled meanwhile.
+    """
+
+    # Profile of the process in progress
+    active_profile = None
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.server = conf.get('execution_server')
+        self.sample_rate = int(conf.get('profile_sample_rate', 0))
+        self.profile_dir = conf.get('profile_dir',
+                                    '/var/log/swift/crystal_profile')
+        self.max_files = int(conf.get('profile_max_files', 100))
+        self.top_functions = int(conf.get('profile_top_functions', 20))
+
+    def is_profiled(self, req):
+        if CrystalProfiler.active_profile:
+            req.headers.pop(PROFILE_HEADER, None)
+            return False
+
+        if PROFILE_HEADER in req.headers:
+            if self.server == 'proxy' and \
+                    not req.environ.get('reseller_request'):
+                # Only reseller admins can ask for a profile
+                req.headers.pop(PROFILE_HEADER)
+                return False
+            return True
+
+        if self.sample_rate and random.randint(1, self.sample_rate) == 1:
+            # Also profile the execution in the object server
+            req.headers[PROFILE_HEADER] = 'sampled'
+            return True
+
+        return False
+
+    def profile(self, handle_request, req):
+        import cProfile
+        profile = cProfile.Profile()
+        name = '%017.6f-%s-%s-%s' % (time.time(), self.server, req.method,
+                                     req.environ.get('swift.trans_id', ''))
+
+        CrystalProfiler.active_profile = profile
+        profile.enable()
+        try:
+            resp = handle_request(req)
+        except Exception:
+            profile.disable()
+            self._finish(profile, name)
+            raise
+        profile.disable()
+
+        if resp.app_iter is None or isinstance(resp.app_iter, (list, tuple)):
+            self._finish(profile, name)
+        else:
+            resp.app_iter = ProfiledIter(resp.app_iter, profile,
+                                         lambda: self._finish(profile, name))
+        return resp
+
+    def _finish(self, profile, name):
+        CrystalProfiler.active_profile = None
+        self._dump(profile, name)
+
+    def _rotate(self):
+        profiles = sorted(f for f in os.listdir(self.profile_dir)
+                          if f.endswith('.prof'))
+        for profile_file in profiles[:-self.max_files]:
+            for path in (profile_file, profile_file[:-5] + '.txt'):
+                try:
+                    os.unlink(os.path.join(self.profile_dir, path))
+                except OSError:
+                    pass
+
+    def _dump(self, profile, name):
+        from StringIO import StringIO
+        import pstats
+        try:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+
+            profile_path = os.path.join(self.profile_dir, name + '.prof')
+            profile.dump_stats(profile_path)
+
+            summary = StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('tottime').print_stats(self.top_functions)
+            stats.sort_stats('cumulative').print_stats(self.top_functions)
+            with open(profile_path[:-5] + '.txt', 'w') as summary_file:
+                summary_file.write(summary.getvalue())
+
+            self._rotate()
+            self.logger.info('Crystal Filters - Profile written to ' +
+                             profile_path)
+        except Exception:
+            self.logger.exception('Crystal Filters - Error writing profile')
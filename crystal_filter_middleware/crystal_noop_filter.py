@@ -0,0 +1,24 @@
+from swift.common.swob import Request
+from crystal_filter_control import Singleton
+
+
+@Singleton
+class CrystalNoopFilter(object):
+    """
+    Native filter that returns the data as it is. It measures the cost of
+    the filter pipeline itself (policy lookup, execution lists, Crystal
+    metadata and reverse execution), i.e. in tools/crystal_load_test.py.
+    """
+
+    def __init__(self, filter_conf, global_conf, logger):
+        self.logger = logger
+        self.filter_conf = filter_conf
+        self.global_conf = global_conf
+
+    def execute(self, req_resp, crystal_iter, request_data):
+        if crystal_iter is None:
+            if isinstance(req_resp, Request):
+                crystal_iter = req_resp.environ['wsgi.input']
+            else:
+                crystal_iter = req_resp.app_iter
+        return crystal_iter
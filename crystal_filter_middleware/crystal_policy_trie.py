@@ -0,0 +1,154 @@
+import time
+
+PIPELINE_PREFIX = 'pipeline:'
+
+
+class _TrieNode(object):
+    __slots__ = ('edges', 'target')
+
+    def __init__(self):
+        # First character of the edge label -> (label, child node)
+        self.edges = dict()
+        self.target = None
+
+
+def _common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PolicyTrie(object):
+    """
+    Radix trie of the pipeline policy targets of an account.
+
+    A target ending with '/' is a pseudo-directory prefix (for example
+    'AUTH_test/logs/2016/'), and it matches all the objects below it. Any
+    other target (account, container or object) matches the same path or
+    any path below it, so 'AUTH_test/logs' does not match 'AUTH_test/logs2'.
+    """
+
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def insert(self, target):
+        node = self.root
+        key = target
+        while key:
+            edge = node.edges.get(key[0])
+            if edge is None:
+                leaf = _TrieNode()
+                leaf.target = target
+                node.edges[key[0]] = (key, leaf)
+                return
+            label, child = edge
+            common = _common_prefix_length(label, key)
+            if common < len(label):
+                # Split the edge
+                middle = _TrieNode()
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[key[0]] = (label[:common], middle)
+                child = middle
+            node = child
+            key = key[common:]
+        node.target = target
+
+    def remove(self, target):
+        path = []
+        node = self.root
+        key = target
+        while key:
+            edge = node.edges.get(key[0])
+            if edge is None or not key.startswith(edge[0]):
+                return
+            path.append((node, key[0]))
+            node = edge[1]
+            key = key[len(edge[0]):]
+        node.target = None
+
+        # Prune the leaf, and merge the node left with a single child
+        if not node.edges and path:
+            parent, first = path.pop()
+            del parent.edges[first]
+            node = parent
+        if path and node.target is None and len(node.edges) == 1:
+            parent, first = path[-1]
+            label = parent.edges[first][0]
+            child_label, child = list(node.edges.values())[0]
+            parent.edges[first] = (label + child_label, child)
+
+    def longest_match(self, path):
+        """
+        Longest policy target that matches path, in O(len(path))
+        :param path: account/container/object path
+        :returns: the target, or None if there is no matching target
+        """
+        node = self.root
+        position = 0
+        best = None
+        while True:
+            if node.target is not None and \
+                    (position == len(path) or path[position - 1] == '/' or
+                     path[position] == '/'):
+                best = node.target
+            if position == len(path):
+                break
+            edge = node.edges.get(path[position])
+            if edge is None or not path.startswith(edge[0], position):
+                break
+            position += len(edge[0])
+            node = edge[1]
+        return best
+
+
+class PolicyTrieCache(object):
+    """
+    Policy tries of the accounts served by this process. The trie of an
+    account is refreshed, at most every 'pipeline_cache_ttl' seconds, by
+    inserting and removing only the targets that changed in Redis.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.ttl = float(conf.get('pipeline_cache_ttl', 5))
+        # account -> (trie, targets, refresh time)
+        self.tries = dict()
+
+    def _refresh(self, redis, account, now):
+        keys = redis.keys(PIPELINE_PREFIX + account + '*')
+        targets = set()
+        for key in keys:
+            target = key[len(PIPELINE_PREFIX):]
+            if target == account or target.startswith(account + '/'):
+                targets.add(target)
+
+        if account in self.tries:
+            trie, old_targets, _ = self.tries[account]
+        else:
+            trie, old_targets = PolicyTrie(), set()
+
+        for target in old_targets - targets:
+            trie.remove(target)
+        for target in targets - old_targets:
+            trie.insert(target)
+
+        self.tries[account] = (trie, targets, now)
+        return trie
+
+    def lookup(self, redis, account, path):
+        """
+        Get the policy target of a request
+        :param redis: Redis connection
+        :param account: account of the request
+        :param path: account/container/object path of the request
+        :returns: the most specific target, or None
+        """
+        now = time.time()
+        entry = self.tries.get(account)
+        if entry is None or now - entry[2] > self.ttl:
+            trie = self._refresh(redis, account, now)
+        else:
+            trie = entry[0]
+        return trie.longest_match(path)
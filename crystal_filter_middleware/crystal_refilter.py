@@ -0,0 +1,256 @@
+"""
+Bulk re-filtering of the objects already stored in an account or container.
+
+When a pipeline is added or changed, only the new PUTs are filtered. This
+tool walks the listings and rewrites each object through the proxy pipeline
+of an internal client that includes the Crystal filter middleware, so the
+objects are read with their old filters reversed, and stored with the
+current ones by the same CrystalFilterControl code path of the clients.
+The GETs of the tool skip the current GET filters of the middleware, so
+only the reverse filters stored with each object are applied.
+Objects whose plan hash already matches the current policies are skipped.
+
+The internal client configuration must have the crystal_filter_handler
+filter (execution_server = proxy) in its pipeline, and its Redis settings
+are also used by this tool.
+
+Usage:
+    crystal-refilter [options] <account> [<container>]
+"""
+from swift.common.internal_client import InternalClient
+from swift.common.internal_client import UnexpectedResponse
+from swift.common.swob import Request
+from swift.common.utils import FileLikeIter
+from swift.common.utils import Timestamp
+from swift.common.utils import get_logger
+from swift.common.utils import readconf
+from swift.common.http import is_success
+from crystal_filter_handler import SDSFilterProxyHandler
+from crystal_policy_trie import PolicyTrieCache
+from optparse import OptionParser
+from collections import deque
+from eventlet import GreenPool
+import crystal_filter_common as sc
+import json
+import time
+import sys
+import os
+
+
+class RefilterProgress(object):
+    """
+    Tracks the objects of a container processed in parallel, and keeps as
+    marker the last object of the listing that has been processed along
+    with all the previous ones
+    """
+
+    def __init__(self, marker):
+        self.marker = marker
+        self.pending = deque()
+        self.finished = set()
+
+    def start(self, obj):
+        self.pending.append(obj)
+
+    def finish(self, obj):
+        self.finished.add(obj)
+        while self.pending and self.pending[0] in self.finished:
+            self.marker = self.pending.popleft()
+            self.finished.remove(self.marker)
+
+
+class CrystalRefilter(object):
+
+    def __init__(self, conf_path, conf, logger):
+        self.logger = logger
+        self.concurrency = int(conf.get('concurrency', 32))
+        self.checkpoint_file = conf.get('checkpoint_file')
+        self.checkpoint_interval = float(conf.get('checkpoint_interval', 10))
+        self.client = InternalClient(conf_path, 'Crystal Refilter',
+                                     int(conf.get('request_tries', 3)))
+
+        crystal_conf = readconf(conf_path, 'filter:crystal_filter_handler')
+        self.crystal_conf = {
+            'execution_server': 'proxy',
+            'redis_host': crystal_conf.get('redis_host', 'controller'),
+            'redis_port': crystal_conf.get('redis_port', 6379),
+            'redis_db': crystal_conf.get('redis_db', 0),
+            'pipeline_cache_ttl': crystal_conf.get('pipeline_cache_ttl', 5)}
+        self.policy_cache = PolicyTrieCache(self.crystal_conf, self.logger)
+
+        self.stats = {'rewritten': 0, 'skipped': 0, 'failed': 0}
+        self.checkpoint = dict()
+        self.last_checkpoint = 0
+
+    def _load_checkpoint(self, account, scope):
+        """
+        Load the checkpoint of an interrupted run, if it was run on the same
+        account and scope (container, or '' for the whole account)
+        """
+        if not self.checkpoint_file or \
+                not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('account') != account or \
+                checkpoint.get('scope') != scope:
+            self.logger.warning('Crystal Refilter - Ignoring the checkpoint '
+                                'of another account or container')
+            return
+        self.checkpoint = checkpoint
+        self.logger.info('Crystal Refilter - Resuming from container %s '
+                         'and object %s' % (self.checkpoint['container'],
+                                            self.checkpoint['marker']))
+
+    def _save_checkpoint(self, container, marker, force=False):
+        now = time.time()
+        if not self.checkpoint_file or \
+                (not force and
+                 now - self.last_checkpoint < self.checkpoint_interval):
+            return
+        self.checkpoint.update({'container': container, 'marker': marker})
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as checkpoint_file:
+            json.dump(self.checkpoint, checkpoint_file)
+        os.rename(tmp_file, self.checkpoint_file)
+        self.last_checkpoint = now
+
+    def _target_plan_hash(self, path, headers):
+        """
+        Plan hash of the current policies for an object, computed as the
+        proxy does on PUT
+        """
+        size = headers.get(sc.ORIGINAL_SIZE_SYSMETA,
+                           headers.get('Content-Length'))
+        req = Request.blank(path, environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'Content-Type': headers['Content-Type'],
+                                     'Content-Length': size})
+        handler = SDSFilterProxyHandler(req, self.crystal_conf, None,
+                                        self.logger, None, self.policy_cache)
+        if not (handler.global_filters or handler.filter_list):
+            return ''
+        return sc.plan_hash(handler._build_filter_execution_list())
+
+    def _get_stored_object(self, path):
+        """
+        GET of the stored data of an object. It is sent directly to the
+        internal client pipeline, since the environ flag that makes the
+        middleware skip the GET filters can not be set through make_request.
+        """
+        req = Request.blank(path,
+                            environ={'REQUEST_METHOD': 'GET',
+                                     'swift.source': sc.REFILTER_SOURCE},
+                            headers={'User-Agent': self.client.user_agent})
+        resp = req.get_response(self.client.app)
+        if not is_success(resp.status_int):
+            if hasattr(resp.app_iter, 'close'):
+                resp.app_iter.close()
+            raise UnexpectedResponse('Unexpected response: %s' % resp.status,
+                                     resp)
+        return resp
+
+    def _rewrite_object(self, path):
+        get_resp = self._get_stored_object(path)
+
+        # Older than any later client write, newer than the current object.
+        # X-Timestamp is in normal form, without the offset of the objects
+        # already rewritten.
+        timestamp = Timestamp(get_resp.headers['X-Backend-Timestamp'],
+                              offset=1)
+        put_headers = {'Content-Type': get_resp.headers['Content-Type'],
+                       'X-Timestamp': timestamp.internal}
+        for key, value in get_resp.headers.items():
+            if key.lower().startswith('x-object-meta-') or \
+                    key.lower() in sc.COPIED_HEADERS:
+                put_headers[key] = value
+        if get_resp.headers.get('ETag'):
+            put_headers['ETag'] = get_resp.headers['ETag'].strip('"')
+        if get_resp.headers.get('Content-Length'):
+            put_headers['Content-Length'] = get_resp.headers['Content-Length']
+
+        self.client.make_request('PUT', path, put_headers, (2,),
+                                 body_file=FileLikeIter(get_resp.app_iter))
+
+    def refilter_object(self, account, container, obj, progress):
+        path = self.client.make_path(account, container, obj)
+        try:
+            head_resp = self.client.make_request('HEAD', path, {}, (2,))
+            headers = head_resp.headers
+            if 'X-Static-Large-Object' in headers or \
+                    'X-Object-Manifest' in headers:
+                # Segments are filtered as any other object
+                self.stats['skipped'] += 1
+            elif self._target_plan_hash(path, headers) == \
+                    headers.get(sc.PLAN_HASH_SYSMETA, ''):
+                self.stats['skipped'] += 1
+            else:
+                self._rewrite_object(path)
+                self.stats['rewritten'] += 1
+        except Exception:
+            self.logger.exception('Crystal Refilter - Error refiltering ' +
+                                  path)
+            self.stats['failed'] += 1
+        finally:
+            progress.finish(obj)
+
+    def refilter_container(self, pool, account, container, marker=''):
+        progress = RefilterProgress(marker)
+        for obj in self.client.iter_objects(account, container,
+                                            marker=marker):
+            progress.start(obj['name'])
+            pool.spawn_n(self.refilter_object, account, container,
+                         obj['name'], progress)
+            self._save_checkpoint(container, progress.marker)
+        pool.waitall()
+        self._save_checkpoint(container, progress.marker, force=True)
+
+    def run(self, account, container=None):
+        self.checkpoint = {'account': account, 'scope': container or ''}
+        self._load_checkpoint(account, container or '')
+        pool = GreenPool(self.concurrency)
+
+        if container:
+            containers = [container]
+        else:
+            containers = (c['name'] for c in
+                          self.client.iter_containers(account))
+
+        for container in containers:
+            marker = ''
+            if container == self.checkpoint.get('container'):
+                marker = self.checkpoint['marker']
+            elif container < self.checkpoint.get('container', ''):
+                # Already refiltered in the interrupted run of the account
+                continue
+            self.logger.info('Crystal Refilter - Refiltering %s/%s' %
+                             (account, container))
+            self.refilter_container(pool, account, container, marker)
+
+        self.logger.info('Crystal Refilter - Done: %(rewritten)d rewritten, '
+                         '%(skipped)d skipped, %(failed)d failed' % self.stats)
+        return self.stats
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] <account> [<container>]')
+    parser.add_option('--conf', default='/etc/swift/crystal-refilter.conf',
+                      help='Internal client configuration with the Crystal '
+                      'filter middleware [%default]')
+    parser.add_option('--concurrency', type='int', default=32,
+                      help='Objects refiltered in parallel [%default]')
+    parser.add_option('--checkpoint', default=None,
+                      help='Checkpoint file to resume an interrupted run')
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error('An account is required')
+
+    conf = {'concurrency': options.concurrency,
+            'checkpoint_file': options.checkpoint}
+    logger = get_logger({}, log_route='crystal-refilter', log_to_console=True)
+    refilter = CrystalRefilter(options.conf, conf, logger)
+    stats = refilter.run(*args)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,9 @@ from setuptools import setup
 paste_factory = ['crystal_filter_handler = '
                  'crystal_filter_middleware.crystal_filter_handler:filter_factory']
 
+console_scripts = ['crystal-refilter = '
+                   'crystal_filter_middleware.crystal_refilter:main']
+
 setup(name='swift_crystal_filter_middleware',
       version='0.0.4',
       description='Crystal filter middleware for OpenStack Swift',
@@ -10,5 +13,6 @@ setup(name='swift_crystal_filter_middleware',
       url='http://iostack.eu',
       packages=['crystal_filter_middleware'],
       requires=['swift(>=1.4)','storlets(>=1.0)'],
-      entry_points={'paste.filter_factory':paste_factory}
+      entry_points={'paste.filter_factory':paste_factory,
+                    'console_scripts':console_scripts}
       )
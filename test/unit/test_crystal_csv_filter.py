@@ -0,0 +1,111 @@
+from io import BytesIO
+import unittest
+import sys
+import os
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, os.pardir, 'crystal_filter_middleware')
+sys.path.insert(0, PACKAGE_DIR)
+
+try:
+    import numpy
+    from crystal_csv_filter import CSVQuery
+    from crystal_csv_filter import CSVFilterIter
+except ImportError:
+    numpy = None
+
+DATA = (b'id,name,price\n'
+        b'1,apple,60\n'
+        b'2,banana,\n'
+        b'3,cherry,x\n'
+        b'4,date,61.5\n'
+        b'5,elderberry,7\n')
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@unittest.skipIf(numpy is None, 'NumPy or Swift are not installed')
+class TestCSVFilter(unittest.TestCase):
+
+    def _filter(self, params, data=DATA, chunk_size=None):
+        chunks = chunked(data, chunk_size) if chunk_size else [data]
+        return b''.join(CSVFilterIter(iter(chunks), CSVQuery(params), None))
+
+    def test_select_where(self):
+        self.assertEqual(self._filter('select=name|price,where=price>=60'),
+                         b'name,price\napple,60\ndate,61.5\n')
+
+    def test_string_predicates(self):
+        self.assertEqual(self._filter('select=id,where=name==banana'),
+                         b'id\n2\n')
+        self.assertEqual(self._filter('select=id,where=name<c'),
+                         b'id\n1\n2\n')
+        self.assertEqual(self._filter('select=id,where=name>cherry'),
+                         b'id\n4\n5\n')
+        self.assertEqual(self._filter('select=id,where=name!=apple'),
+                         b'id\n2\n3\n4\n5\n')
+
+    def test_non_numeric_fields(self):
+        # Empty and non-numeric prices never meet a numeric predicate
+        self.assertEqual(self._filter('select=id,where=price!=60'),
+                         b'id\n4\n5\n')
+        self.assertEqual(self._filter('select=id,where=price<100'),
+                         b'id\n1\n4\n5\n')
+
+    def test_no_header(self):
+        data = b'1;x\n2;y\n3;z\n'
+        self.assertEqual(
+            self._filter('header=false,delimiter=semicolon,select=1,'
+                         'where=0>=2', data),
+            b'y\nz\n')
+
+    def test_crlf(self):
+        data = DATA.replace(b'\n', b'\r\n')
+        self.assertEqual(self._filter('select=price,where=price>7', data),
+                         b'price\n60\n61.5\n')
+        # Rows are sent as they are without projection
+        self.assertEqual(self._filter('where=id==1', data),
+                         b'id,name,price\n1,apple,60\r\n')
+
+    def test_rows_split_across_chunks(self):
+        expected = self._filter('select=name,where=price>1')
+        for chunk_size in (1, 2, 3, 5, 7, 16):
+            self.assertEqual(self._filter('select=name,where=price>1',
+                                          chunk_size=chunk_size), expected)
+
+    def test_last_row_without_newline(self):
+        self.assertEqual(self._filter('where=id>4', DATA[:-1]),
+                         b'id,name,price\n5,elderberry,7\n')
+
+    def test_rows_with_other_number_of_fields(self):
+        data = DATA + b'6,fig\n7,grape,1,extra\n8,kiwi,2\n'
+        self.assertEqual(self._filter('select=id,where=id>5', data),
+                         b'id\n8\n')
+
+    def test_wide_field(self):
+        wide = b'w' * 20000
+        data = b'id,desc,price\n' + b''.join(
+            b'%d,short,%d\n' % (i, i) for i in range(5000))
+        data += b'5000,' + wide + b',' + b'9' * 100 + b'\n'
+        output = self._filter('select=id,where=desc==short|id>4990', data,
+                              chunk_size=65536)
+        self.assertEqual(output, b'id\n' + b''.join(
+            b'%d\n' % i for i in range(4991, 5000)))
+        self.assertEqual(self._filter('select=id,where=desc>short', data),
+                         b'id\n5000\n')
+        self.assertEqual(self._filter('select=id,where=price>1e99', data),
+                         b'id\n5000\n')
+
+    def test_read(self):
+        # PUT: file-like source, and read by the proxy
+        filter_iter = CSVFilterIter(BytesIO(DATA),
+                                    CSVQuery('select=id,where=price>7'), None)
+        self.assertEqual(filter_iter.read(3), b'id\n')
+        self.assertEqual(filter_iter.read(), b'1\n4\n')
+        self.assertEqual(filter_iter.read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
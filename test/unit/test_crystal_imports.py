@@ -0,0 +1,58 @@
+import subprocess
+import unittest
+import json
+import sys
+import os
+
+try:
+    import swift
+except ImportError:
+    swift = None
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, os.pardir, 'crystal_filter_middleware')
+
+# Modules that must only be loaded when a request needs them
+LAZY_MODULES = ('storlet_gateway', 'crystal_filter_storlet_gateway', 'redis',
+                'swift.obj.diskfile')
+
+IMPORT_SCRIPT = '''
+import json
+import time
+import sys
+start = time.time()
+import crystal_filter_handler
+print(json.dumps({'time': time.time() - start,
+                  'modules': sorted(sys.modules)}))
+'''
+
+
+@unittest.skipIf(swift is None, 'Swift is not installed')
+class TestMiddlewareImport(unittest.TestCase):
+
+    def _import_handler(self):
+        # A new interpreter, so the modules loaded by other tests do not count
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_DIR] + [path for path in sys.path if path])
+        output = subprocess.check_output([sys.executable, '-c',
+                                          IMPORT_SCRIPT], env=env)
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def test_heavy_modules_not_loaded(self):
+        modules = self._import_handler()['modules']
+        for lazy_module in LAZY_MODULES:
+            loaded = [module for module in modules
+                      if module == lazy_module or
+                      module.startswith(lazy_module + '.')]
+            self.assertEqual(loaded, [], '%s loaded on import' % lazy_module)
+
+    def test_import_time(self):
+        max_time = float(os.environ.get('CRYSTAL_MAX_IMPORT_TIME', 0))
+        if not max_time:
+            self.skipTest('CRYSTAL_MAX_IMPORT_TIME is not set')
+        self.assertLess(self._import_handler()['time'], max_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+Macro load-test harness for the Crystal filter middleware.
+
+It runs the proxy and object SDSFilterHandlerMiddleware instances in-process
+over an in-memory object store and a Redis stand-in, and replays a GET/PUT
+mix with N concurrent greenthreads. The report contains the requests per
+second, MB/s and latency percentiles, so changes can be compared before and
+after.
+
+The objects are stored as files in a tmpfs directory (/dev/shm by default),
+since the Crystal metadata is kept in extended attributes.
+
+The tenants with a policy get a 'pipeline:<tenant>' policy of --filters
+pass-through native stages with reverse execution, so PUTs go through the
+policy lookup and store the executed filter list, and GETs execute it in
+reverse (coalesced with --coalesce). The last --deferred stages are executed
+by the deferred worker. Bandwidth control is set apart with the global
+--bandwidth-filters and the 'bandwidth:<tenant>' limits of --bandwidth-share.
+
+Example:
+    python tools/crystal_load_test.py --requests 5000 --concurrency 64 \\
+        --put-ratio 0.3 --sizes 4096,1048576 --filters 2 --policy-share 0.5 \\
+        --deferred 1 --coalesce --bandwidth-filters 1 --bandwidth-share 0.5
+"""
+from swift.common.swob import Request
+from swift.common.swob import Response
+from swift.common.utils import Timestamp
+from swift.common.utils import get_logger
+from optparse import OptionParser
+import eventlet
+import fnmatch
+import hashlib
+import random
+import tempfile
+import shutil
+import redis
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Time to import the middleware, which delays the restart of the workers
+import_start = time.time()
+from crystal_filter_middleware import crystal_filter_handler
+from crystal_filter_middleware.crystal_filter_control import \
+    CrystalFilterControl
+IMPORT_TIME = time.time() - import_start
+
+BANDWIDTH_FILTER = 'crystal_bandwidth_control.CrystalBandwidthControl'
+NOOP_FILTER = 'crystal_noop_filter.CrystalNoopFilter'
+MB = 1024 * 1024
+FOOTERS_KEY = 'crystal_load_test.footers'
+
+
+class FakeRedis(object):
+    """
+    Local Redis stand-in with the subset of commands used by the middleware.
+    All the instances share the same data, as the clients of a Redis server.
+    """
+    data = dict()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def keys(self, pattern='*'):
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value)
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def lrange(self, key, start, end):
+        values = self.data.get(key, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def expire(self, key, seconds):
+        return True
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((getattr(self.client, name), args))
+            return self
+        return command
+
+    def execute(self):
+        results = [func(*args) for func, args in self.commands]
+        self.commands = []
+        return results
+
+
+class StoredObjectIter(object):
+    """
+    Object app_iter that exposes the same attributes of the Swift
+    DiskFileReader that the middleware relies on
+    """
+
+    def __init__(self, data_file, chunk_size):
+        self._data_file = data_file
+        self._fp = open(data_file, 'rb')
+        self._disk_chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._fp.read(self._disk_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+
+class FooterInput(object):
+    """
+    Calls the footers callback of the middlewares once all the data has been
+    read, as the Swift proxy does, and leaves the footers in the environ
+    """
+
+    def __init__(self, source, env):
+        self.source = source
+        self.env = env
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        if not chunk and FOOTERS_KEY not in self.env:
+            footers = dict()
+            self.env.get('swift.callback.update_footers',
+                         lambda footers: None)(footers)
+            self.env[FOOTERS_KEY] = footers
+        return chunk
+
+
+class MemoryObjectServer(object):
+    """
+    Object server stand-in: objects in a tmpfs directory, metadata in memory
+    """
+
+    def __init__(self, data_dir, logger, chunk_size=65536):
+        self.data_dir = data_dir
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.metadata = dict()
+
+    def _data_file(self, path):
+        return os.path.join(self.data_dir,
+                            hashlib.md5(path).hexdigest() + '.data')
+
+    def _headers(self, path):
+        # Copy, so the middleware can change the headers of its response
+        return dict(self.metadata[path])
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        _, _, account, container, obj = req.split_path(5, 5, True)
+        path = '/'.join((account, container, obj))
+        data_file = self._data_file(path)
+
+        if req.method == 'PUT':
+            etag = hashlib.md5()
+            tmp_file = data_file + '.' + str(id(req))
+            with open(tmp_file, 'wb') as fp:
+                while True:
+                    chunk = req.environ['wsgi.input'].read(self.chunk_size)
+                    if not chunk:
+                        break
+                    etag.update(chunk)
+                    fp.write(chunk)
+            footers = req.environ.get(FOOTERS_KEY, {})
+            if footers.get('Etag', etag.hexdigest()) != etag.hexdigest():
+                os.unlink(tmp_file)
+                resp = Response(status=422)
+                return resp(env, start_response)
+
+            # A new file, as Swift does, so old xattrs are not inherited
+            os.rename(tmp_file, data_file)
+            headers = dict((key, value) for key, value in
+                           req.headers.items() + footers.items()
+                           if key.lower().startswith(('x-object-meta-',
+                                                      'x-object-sysmeta-')))
+            headers['Content-Type'] = req.headers.get(
+                'Content-Type', 'application/octet-stream')
+            headers['ETag'] = etag.hexdigest()
+            headers['X-Timestamp'] = \
+                Timestamp(req.headers['X-Timestamp']).normal
+            headers['X-Backend-Timestamp'] = \
+                Timestamp(req.headers['X-Timestamp']).internal
+            headers['Content-Length'] = str(os.path.getsize(data_file))
+            self.metadata[path] = headers
+            resp = Response(status=201, headers={'ETag': headers['ETag']})
+
+        elif req.method in ('GET', 'HEAD'):
+            if path not in self.metadata:
+                resp = Response(status=404)
+            elif req.method == 'HEAD':
+                resp = Response(status=200, headers=self._headers(path))
+            else:
+                resp = Response(status=200, headers=self._headers(path),
+                                app_iter=StoredObjectIter(data_file,
+                                                          self.chunk_size))
+        else:
+            resp = Response(status=405)
+
+        return resp(env, start_response)
+
+
+class ProxyServer(object):
+    """
+    Proxy server stand-in that forwards the object requests to the object
+    server pipeline of a single node
+    """
+
+    def __init__(self, object_pipeline, logger):
+        self.object_pipeline = object_pipeline
+        self.logger = logger
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        version, account, container, obj = req.split_path(2, 4, True)
+        if not obj:
+            resp = Response(status=204,
+                            headers={'X-Account-Container-Count': '0',
+                                     'X-Account-Object-Count': '0',
+                                     'X-Account-Bytes-Used': '0'})
+            return resp(env, start_response)
+
+        env['PATH_INFO'] = '/sda1/0/' + '/'.join((account, container, obj))
+        if req.method == 'PUT':
+            env['HTTP_X_TIMESTAMP'] = Timestamp(time.time()).internal
+            env['wsgi.input'] = FooterInput(env['wsgi.input'], env)
+        return self.object_pipeline(env, start_response)
+
+
+class LoadTest(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.sizes = [int(size) for size in options.sizes.split(',')]
+        self.payloads = dict((size, os.urandom(size)) for size in self.sizes)
+        self.tenants = ['AUTH_tenant%d' % i for i in range(options.tenants)]
+        self.results = {'GET': [], 'PUT': []}
+        self.errors = 0
+        self.bytes = 0
+
+        self.data_dir = options.data_dir
+        self._setup_policies()
+        self.proxy = self._setup_pipeline()
+
+    def _setup_policies(self):
+        # The middleware and the filters connect to the Redis stand-in
+        redis.StrictRedis = FakeRedis
+        FakeRedis.data.clear()
+        client = FakeRedis()
+
+        for order in range(self.options.bandwidth_filters):
+            client.hset('global_filters', str(order), json.dumps(
+                {'is_get': True, 'is_put': True, 'main': BANDWIDTH_FILTER,
+                 'execution_server': self.options.filter_server}))
+
+        with_bandwidth = int(len(self.tenants) * self.options.bandwidth_share)
+        for tenant in self.tenants[:with_bandwidth]:
+            for method in ('get', 'put'):
+                client.hset('bandwidth:' + tenant, method + '_bw',
+                            self.options.rate)
+
+        # Pipeline stages after the global filters, the last ones deferred
+        first_deferred = self.options.filters - self.options.deferred
+        with_policy = int(len(self.tenants) * self.options.policy_share)
+        for tenant in self.tenants[:with_policy]:
+            for stage in range(self.options.filters):
+                filter_id = str(stage + 1)
+                client.hset('pipeline:' + tenant, filter_id, json.dumps(
+                    {'name': 'noop%d' % stage, 'filter_id': filter_id,
+                     'filter_type': 'native', 'main': NOOP_FILTER,
+                     'params': 'stage=%d' % stage, 'dependencies': '',
+                     'content_length': 0, 'has_reverse': True,
+                     'execution_server': self.options.filter_server,
+                     'execution_server_reverse':
+                         self.options.reverse_server,
+                     'execution_order': self.options.bandwidth_filters +
+                         stage,
+                     'is_get': False, 'is_put': True,
+                     'object_type': '', 'object_size': '', 'object_tag': '',
+                     'deferred': stage >= first_deferred}))
+
+    def _setup_pipeline(self):
+        # Devices of the object server, for the deferred filter jobs
+        devices = os.path.join(self.data_dir, 'devices')
+        if not os.path.isdir(os.path.join(devices, 'sda1', 'tmp')):
+            os.makedirs(os.path.join(devices, 'sda1', 'tmp'))
+        conf = {'storlet_gateway_conf': '/dev/null',
+                'log_level': self.options.log_level,
+                'devices': devices,
+                'coalesce_gets': str(self.options.coalesce)}
+        logger = get_logger(conf, log_route='crystal_load_test')
+
+        object_factory = crystal_filter_handler.filter_factory(
+            conf, execution_server='object')
+        object_pipeline = object_factory(MemoryObjectServer(self.data_dir,
+                                                           logger))
+
+        # The filter control is a singleton, but here the proxy and the
+        # object servers live in the same process.
+        object_pipeline.filter_control = CrystalFilterControl._decorated(
+            conf=object_pipeline.conf, log=object_pipeline.logger)
+
+        proxy_factory = crystal_filter_handler.filter_factory(
+            conf, execution_server='proxy')
+        proxy_pipeline = proxy_factory(ProxyServer(object_pipeline, logger))
+        proxy_pipeline.filter_control = CrystalFilterControl._decorated(
+            conf=proxy_pipeline.conf, log=proxy_pipeline.logger)
+
+        return proxy_pipeline
+
+    def _object_path(self, tenant, index):
+        return '/v1/%s/container/object%d' % (tenant, index)
+
+    def _put(self, path, size):
+        body = self.payloads[size]
+        req = Request.blank(path, environ={'REQUEST_METHOD': 'PUT'},
+                            body=body,
+                            headers={'Content-Type': 'application/data',
+                                     'ETag': hashlib.md5(body).hexdigest()})
+        resp = req.get_response(self.proxy)
+        return resp.status_int, len(body)
+
+    def _get(self, path):
+        resp = Request.blank(path).get_response(self.proxy)
+        transferred = 0
+        for chunk in resp.app_iter:
+            transferred += len(chunk)
+        if hasattr(resp.app_iter, 'close'):
+            resp.app_iter.close()
+        return resp.status_int, transferred
+
+    def _request(self, _):
+        tenant = random.choice(self.tenants)
+        path = self._object_path(tenant,
+                                 random.randrange(self.options.objects))
+        if random.random() < self.options.put_ratio:
+            method = 'PUT'
+        else:
+            method = 'GET'
+
+        start = time.time()
+        if method == 'PUT':
+            status, transferred = self._put(path, random.choice(self.sizes))
+        else:
+            status, transferred = self._get(path)
+        self.results[method].append(time.time() - start)
+
+        if status // 100 != 2:
+            self.errors += 1
+        self.bytes += transferred
+
+    def populate(self):
+        for tenant in self.tenants:
+            for index in range(self.options.objects):
+                self._put(self._object_path(tenant, index),
+                          random.choice(self.sizes))
+
+    def run(self):
+        pool = eventlet.GreenPool(self.options.concurrency)
+        start = time.time()
+        for _ in pool.imap(self._request, range(self.options.requests)):
+            pass
+        return time.time() - start
+
+    def report(self, elapsed):
+        completed = sum(len(latencies) for latencies in self.results.values())
+        print('Middleware import: %.2f ms' % (IMPORT_TIME * 1000))
+        print('Requests: %d (%d errors) in %.2f s' % (completed, self.errors,
+                                                      elapsed))
+        print('Throughput: %.2f req/s, %.2f MB/s' % (
+            completed / elapsed, self.bytes / float(MB) / elapsed))
+        print('%-6s %8s %10s %10s %10s %10s' % ('Method', 'Count', 'p50 ms',
+                                                'p90 ms', 'p99 ms',
+                                                'max ms'))
+        for method, latencies in sorted(self.results.items()):
+            if not latencies:
+                continue
+            latencies.sort()
+            print('%-6s %8d %10.2f %10.2f %10.2f %10.2f' % (
+                method, len(latencies),
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 90) * 1000,
+                percentile(latencies, 99) * 1000,
+                latencies[-1] * 1000))
+
+
+def percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=1000,
+                      help='Number of requests to replay [%default]')
+    parser.add_option('--concurrency', type='int', default=16,
+                      help='Concurrent greenthreads [%default]')
+    parser.add_option('--put-ratio', type='float', default=0.5,
+                      help='Share of PUT requests [%default]')
+    parser.add_option('--sizes', default='4096,65536,1048576',
+                      help='Comma separated object sizes in bytes '
+                      '[%default]')
+    parser.add_option('--tenants', type='int', default=10,
+                      help='Number of tenants [%default]')
+    parser.add_option('--objects', type='int', default=10,
+                      help='Objects per tenant [%default]')
+    parser.add_option('--filters', type='int', default=1,
+                      help='Pass-through stages of the pipeline policies '
+                      '[%default]')
+    parser.add_option('--deferred', type='int', default=0,
+                      help='Last pipeline stages deferred to the object '
+                      'server worker [%default]')
+    parser.add_option('--filter-server', default='proxy',
+                      choices=['proxy', 'object'],
+                      help='Execution server of the filters [%default]')
+    parser.add_option('--reverse-server', default='object',
+                      choices=['proxy', 'object'],
+                      help='Reverse execution server of the pipeline stages '
+                      '[%default]')
+    parser.add_option('--policy-share', type='float', default=0.5,
+                      help='Share of tenants with pipeline policies '
+                      '[%default]')
+    parser.add_option('--coalesce', action='store_true', default=False,
+                      help='Coalesce the concurrent filtered GETs')
+    parser.add_option('--bandwidth-filters', type='int', default=0,
+                      help='Number of global bandwidth filters [%default]')
+    parser.add_option('--bandwidth-share', type='float', default=0.0,
+                      help='Share of tenants with bandwidth limits '
+                      '[%default]')
+    parser.add_option('--rate', type='float', default=100000,
+                      help='Bandwidth limit rate in MB/s [%default]')
+    parser.add_option('--data-dir', default=None,
+                      help='Directory to store the objects (must support '
+                      'user xattrs) [tmpfs]')
+    parser.add_option('--log-level', default='WARNING',
+                      help='Middleware log level [%default]')
+    options, _ = parser.parse_args()
+    if not 0 <= options.deferred <= options.filters:
+        parser.error('--deferred must be between 0 and --filters')
+
+    created_dir = options.data_dir is None
+    if created_dir:
+        base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        options.data_dir = tempfile.mkdtemp(prefix='crystal_load_test_',
+                                            dir=base_dir)
+    try:
+        load_test = LoadTest(options)
+        load_test.populate()
+        load_test.report(load_test.run())
+    finally:
+        if created_dir:
+            shutil.rmtree(options.data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()